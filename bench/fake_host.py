@@ -0,0 +1,221 @@
+"""
+A local stand-in for the Webfaction SSH host. Replaces the remote operations
+used by the fabfile (run, exists, put, upload_template, rsync_project) and
+local() with fakes that emulate the commands the fabfile runs over an in-memory
+file system, sleeping a configurable latency on every round trip and counting
+the bytes moved.
+"""
+from __future__ import print_function
+
+import hashlib
+import os
+import re
+import subprocess
+import time
+from posixpath import join, normpath
+
+from fabric.api import env
+from fabric.operations import _AttributeString
+
+
+def result(output="", return_code=0):
+    output = _AttributeString(output)
+    output.return_code = return_code
+    output.failed = return_code != 0
+    output.succeeded = not output.failed
+    output.stderr = ""
+    return output
+
+
+class FakeHost(object):
+
+    def __init__(self, latency=0.0, db_size=10 * 1024 * 1024):
+        self.latency = latency
+        self.db_size = db_size
+        self.files = {}
+        self.dirs = set()
+        self.running = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.round_trips = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+
+    def round_trip(self, up=0, down=0):
+        self.round_trips += 1
+        self.bytes_up += up
+        self.bytes_down += down
+        time.sleep(self.latency)
+
+    def install(self, fabfile):
+        """
+        Replaces the remote operations imported by the fabfile.
+        """
+        fabfile._run = self.run
+        fabfile.exists = self.exists
+        fabfile.put = self.put
+        fabfile.upload_template = self.upload_template
+        fabfile.rsync_project = self.rsync_project
+        fabfile.local = self.local
+        fabfile.confirm = lambda *args, **kwargs: True
+        fabfile.getpass = lambda *args, **kwargs: "password"
+
+    # File system
+
+    def path(self, path):
+        if not path.startswith("/"):
+            path = join(env.get("cwd") or "/home/%s" % env.user, path)
+        return normpath(path)
+
+    def write(self, path, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        path = self.path(path)
+        self.files[path] = data
+        self.dirs.add(os.path.dirname(path))
+
+    def read(self, path):
+        return self.files.get(self.path(path), b"")
+
+    def remove(self, path):
+        path = self.path(path)
+        prefix = path.rstrip("/") + "/"
+        for name in [f for f in self.files if f == path or f.startswith(prefix)]:
+            del self.files[name]
+        self.dirs = set(d for d in self.dirs
+                        if d != path and not d.startswith(prefix))
+
+    def exists(self, path, *args, **kwargs):
+        self.round_trip(up=len(path))
+        path = self.path(path)
+        prefix = path.rstrip("/") + "/"
+        return path in self.files or path in self.dirs or any(
+            f.startswith(prefix) for f in self.files)
+
+    # Commands
+
+    def run(self, command, *args, **kwargs):
+        if command.startswith("python ") or "\n" in command:
+            # Python code and scripts only report STATIC_ROOT
+            output = ""
+            if "STATIC_ROOT" in command:
+                output = join(env.proj_path, "static")
+        else:
+            output = "\n".join(line for line in (
+                self.shell(part.strip()) for part in command.split("; ")) if line)
+        self.round_trip(up=len(command), down=len(output))
+        return result(output)
+
+    def shell(self, command):
+        """
+        Emulates a single shell command, returning its output.
+        """
+        match = re.match(r"echo (\w+)=\$\((.*)\)$", command)
+        if match:
+            return "%s=%s" % (match.group(1), self.shell(match.group(2)))
+        match = re.match(r"cat (\S+)( 2>/dev/null)?$", command)
+        if match:
+            return self.read(match.group(1)).decode("utf-8").strip()
+        match = re.match(r"md5sum < (\S+) .*", command)
+        if match:
+            if not self.exists_quietly(match.group(1)):
+                return ""
+            return hashlib.md5(self.read(match.group(1))).hexdigest()
+        if command.startswith("supervisorctl status"):
+            return "1" if self.running else "0"
+        if command.startswith("supervisorctl"):
+            self.running = True
+            return ""
+        match = re.match(r"echo '(.*)' > (\S+)$", command)
+        if match:
+            self.write(match.group(2), match.group(1) + "\n")
+            return ""
+        match = re.match(r"printf '%s\\n' (.*) > (\S+)$", command)
+        if match:
+            self.write(match.group(2), "\n".join(match.group(1).split()) + "\n")
+            return ""
+        match = re.match(r"pg_dump .* > (\S+)$", command)
+        if match:
+            self.write(match.group(1), b"\0" * self.db_size)
+            return ""
+        match = re.match(r"mkdir -p (\S+)$", command)
+        if match:
+            self.dirs.add(self.path(match.group(1)))
+            return ""
+        match = re.match(r"rm (-rf |-f )?(.+)$", command)
+        if match:
+            for path in match.group(2).split():
+                self.remove(path)
+        return ""
+
+    def exists_quietly(self, path):
+        path = self.path(path)
+        return path in self.files
+
+    def put(self, local_path, remote_path, *args, **kwargs):
+        if hasattr(local_path, "read"):
+            data = local_path.read()
+        else:
+            with open(local_path, "rb") as f:
+                data = f.read()
+        self.round_trip(up=len(data))
+        self.write(remote_path, data)
+        return [remote_path]
+
+    def upload_template(self, filename, destination, context=None, *args,
+                        **kwargs):
+        with open(filename, "rb") as f:
+            data = f.read().decode("utf-8")
+        if context:
+            data %= context
+        self.round_trip(up=len(data.encode("utf-8")))
+        self.write(destination, data)
+
+    def rsync_project(self, remote_dir, local_dir=None, exclude=(), upload=True,
+                      *args, **kwargs):
+        """
+        Copies the changed files between local_dir and remote_dir, counting
+        their size like rsync would.
+        """
+        from fabfile import is_excluded
+        local_dir = local_dir or os.getcwd()
+        moved = 0
+        if upload:
+            for dirpath, dirnames, filenames in os.walk(local_dir):
+                rel_dir = os.path.relpath(dirpath, local_dir).replace(os.sep, "/")
+                rel_dir = "" if rel_dir == "." else rel_dir + "/"
+                dirnames[:] = [d for d in dirnames
+                               if not is_excluded(rel_dir + d, exclude)]
+                for name in filenames:
+                    if is_excluded(rel_dir + name, exclude):
+                        continue
+                    with open(os.path.join(dirpath, name), "rb") as f:
+                        data = f.read()
+                    remote_path = join(remote_dir, rel_dir + name)
+                    if self.files.get(remote_path) != data:
+                        self.files[remote_path] = data
+                        moved += len(data)
+            self.round_trip(up=moved)
+        else:
+            prefix = remote_dir.rstrip("/") + "/"
+            moved = sum(len(data) for path, data in self.files.items()
+                        if path.startswith(prefix))
+            self.round_trip(down=moved)
+        return result()
+
+    def local(self, command, capture=False, *args, **kwargs):
+        """
+        Read-only version control commands run for real, since the fabfile
+        inspects the local project with them. Copies to and from the server
+        are counted, and anything else is ignored.
+        """
+        if re.match(r"(git (ls-tree|rev-parse)|hg (id|manifest))", command):
+            return result(subprocess.check_output(command, shell=True)
+                          .decode("utf-8").strip())
+        match = re.match(r"scp \S+:(\S+) \.$", command)
+        if match:
+            self.round_trip(down=len(self.read(match.group(1))))
+        elif command.startswith("scp "):
+            self.round_trip(up=self.db_size)
+        return result()
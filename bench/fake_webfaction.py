@@ -0,0 +1,113 @@
+"""
+A local stand-in for the Webfaction XML-RPC API, keeping its objects in
+memory and sleeping a configurable latency on every call.
+"""
+from __future__ import print_function
+
+import threading
+import time
+
+try:
+    from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+except ImportError:
+    from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+
+class QuietHandler(SimpleXMLRPCRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeWebfaction(object):
+    """
+    Implements the login, list_*, create_* and delete_* API methods used by
+    the fabfile.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.next_port = 20000
+        self.objects = dict((obj_type, []) for obj_type in [
+            "app", "db", "db_user", "domain", "website", "cronjob", "mailbox",
+            "email"])
+
+    def _dispatch(self, method, params):
+        self.calls += 1
+        time.sleep(self.latency)
+        if method.startswith("list_"):
+            return list(self.objects[method[5:-1]])
+        if method.startswith("delete_"):
+            return self.delete(method[7:], *params[1:])
+        if method.startswith("create_") or method == "change_mailbox_password":
+            return getattr(self, method)(*params[1:])
+        if method == "login":
+            return "session", {"username": params[0]}
+        raise ValueError("Unsupported method %s" % method)
+
+    def create_app(self, name, app_type, autostart, extra_info):
+        self.next_port += 1
+        app = {"name": name, "type": app_type, "autostart": autostart,
+               "extra_info": extra_info, "port": self.next_port}
+        self.objects["app"].append(app)
+        return app
+
+    def create_db(self, name, db_type, password):
+        self.objects["db"].append({"name": name, "db_type": db_type})
+        self.objects["db_user"].append({"username": name, "db_type": db_type})
+        return {"name": name}
+
+    def create_domain(self, domain, *subdomains):
+        for obj in self.objects["domain"]:
+            if obj["domain"] == domain:
+                obj["subdomains"].extend(subdomains)
+                return obj
+        obj = {"domain": domain, "subdomains": list(subdomains)}
+        self.objects["domain"].append(obj)
+        return obj
+
+    def create_website(self, name, ip, https, subdomains, *site_apps):
+        site = {"name": name, "ip": ip, "https": https,
+                "subdomains": subdomains, "website_apps": list(site_apps)}
+        self.objects["website"].append(site)
+        return site
+
+    def create_cronjob(self, line):
+        self.objects["cronjob"].append({"name": line})
+        return True
+
+    def create_mailbox(self, name):
+        self.objects["mailbox"].append({"name": name})
+        return {"name": name}
+
+    def change_mailbox_password(self, name, password):
+        return {"name": name}
+
+    def create_email(self, address, targets):
+        self.objects["email"].append({"name": address, "targets": targets})
+        return {"name": address}
+
+    def delete(self, obj_type, name, *args):
+        key = {"domain": "domain", "db_user": "username"}.get(obj_type, "name")
+        before = len(self.objects[obj_type])
+        self.objects[obj_type] = [obj for obj in self.objects[obj_type]
+                                  if obj[key] != name]
+        if len(self.objects[obj_type]) == before:
+            raise ValueError("No %s named %s" % (obj_type, name))
+        return True
+
+
+def serve(latency=0.0, port=0):
+    """
+    Starts a fake API server in a background thread. Returns the fake
+    and the URL to reach it.
+    """
+    fake = FakeWebfaction(latency)
+    server = SimpleXMLRPCServer(("127.0.0.1", port), requestHandler=QuietHandler,
+                                allow_none=True, logRequests=False)
+    server.register_instance(fake)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return fake, "http://127.0.0.1:%s/" % server.server_address[1]
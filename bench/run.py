@@ -0,0 +1,97 @@
+"""
+Benchmarks the fabfile's tasks end to end without a Webfaction account, using
+a fake XML-RPC API server and a fake SSH host. Reports wall time, remote round
+trips, API calls and bytes moved for each task.
+
+Deploy stages run one at a time, since stages run in separate processes
+wouldn't share the fake host. Run it from your project root, where the
+fabfile lives:
+
+    python bench/run.py
+    python bench/run.py --latency 0.08 --api-latency 0.3 create deploy deploy
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Let the fabfile load the FABRIC settings like it does when run by fab
+sys.argv[0] = "fab"
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabric.api import env  # noqa
+from fabric.context_managers import settings as fab_settings  # noqa
+
+import fabfile  # noqa
+from bench.fake_host import FakeHost  # noqa
+from bench.fake_webfaction import serve  # noqa
+
+DEFAULT_TASKS = ["create", "deploy", "deploy", "pushmedia", "pulldb", "pushdb",
+                 "remove"]
+
+
+@contextmanager
+def quiet(verbose):
+    """
+    Silences the tasks' output unless running verbosely.
+    """
+    if verbose:
+        yield
+        return
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("tasks", nargs="*", default=DEFAULT_TASKS)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds per SSH round trip (default 0.05)")
+    parser.add_argument("--api-latency", type=float, default=0.2,
+                        help="seconds per Webfaction API call (default 0.2)")
+    parser.add_argument("--db-size", type=int, default=10,
+                        help="size of the database dumps in MB (default 10)")
+    parser.add_argument("--tool", default="rsync",
+                        help="deploy tool to benchmark (default rsync)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the tasks")
+    args = parser.parse_args()
+
+    api, api_url = serve(args.api_latency)
+    host = FakeHost(args.latency, args.db_size * 1024 * 1024)
+    host.install(fabfile)
+    fabfile.timings_path = os.path.join(tempfile.mkdtemp(), "timings.json")
+    env.webf_api_url = api_url
+    env.deploy_tool = args.tool
+    if args.tool not in env.vcs_tools:
+        env.repo_path = env.proj_path
+    env.django_helper = False
+    env.deploy_jobs = 1
+    env.password = env.db_pass = "password"
+
+    print("%-10s %9s %11s %9s %12s %12s" % (
+        "task", "wall (s)", "round trips", "API calls", "uploaded", "downloaded"))
+    for name in args.tasks:
+        host.reset_stats()
+        api.calls = 0
+        start = time.time()
+        with quiet(args.verbose):
+            with fab_settings(host_string="127.0.0.1", abort_exception=RuntimeError):
+                getattr(fabfile, name)()
+        print("%-10s %9.2f %11d %9d %12d %12d" % (
+            name, time.time() - start, host.round_trips, api.calls,
+            host.bytes_up, host.bytes_down))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Streams the gunicorn access log (including rotated and gzipped copies) and
+reports throughput, latency percentiles and status codes by URL pattern.
+Memory use is bounded: latencies are kept in log-scale histograms, and URLs
+are grouped by the Django view they resolve to.
+
+Usage: python analyzelogs.py <access log> <project app> <hours> <limit>
+"""
+from __future__ import division, print_function
+
+import calendar
+import glob
+import gzip
+import math
+import os
+import re
+import sys
+import time
+
+from bootstrap import setup_django
+
+log_path, proj_app, hours, limit = sys.argv[1:5]
+hours, limit = float(hours), int(limit)
+cutoff = time.time() - hours * 3600
+
+# Lines written with the access_log_format in gunicorn.conf.py
+line_re = re.compile(br"^\[(\d+)/(\w+)/(\d+):(\d+):(\d+):(\d+) ([-+])(\d\d)(\d\d)\] "
+                     br"(\S+) (\S+) (\d{3}) \S+ (\d+)")
+months = dict((name.encode("ascii"), i + 1) for i, name in enumerate(
+    "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()))
+
+# Histogram buckets grow 5% each, from 1ms up to about 10 minutes
+bucket_growth = math.log(1.05)
+num_buckets = int(math.log(600000) / bucket_growth) + 2
+
+
+def bucket(ms):
+    return min(int(math.log(max(ms, 1)) / bucket_growth), num_buckets - 1)
+
+
+def bucket_ms(index):
+    return math.exp((index + 0.5) * bucket_growth)
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.errors = 0
+        self.histogram = [0] * num_buckets
+
+    def add(self, ms, status):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.errors += status >= 500
+        self.histogram[bucket(ms)] += 1
+
+    def percentile(self, pct):
+        rank = self.count * pct / 100
+        seen = 0
+        for index, hits in enumerate(self.histogram):
+            seen += hits
+            if hits and seen >= rank:
+                return min(bucket_ms(index), self.max_ms)
+        return self.max_ms
+
+
+def log_files():
+    """
+    The log and its rotated copies, oldest first, skipping the ones that
+    were last written before the window started.
+    """
+    paths = [p for p in glob.glob(log_path + "*") if os.path.isfile(p)]
+    paths = [p for p in paths if os.path.getmtime(p) >= cutoff]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def make_resolver():
+    """
+    Returns a function mapping a path to the name of the view serving it.
+    """
+    setup_django(proj_app)
+    try:
+        from django.urls import Resolver404, resolve
+    except ImportError:
+        from django.core.urlresolvers import Resolver404, resolve
+    cache = {}
+
+    def resolver(path):
+        if path not in cache:
+            if len(cache) > 20000:
+                cache.clear()
+            try:
+                match = resolve(path.decode("utf-8", "replace"))
+            except Resolver404:
+                cache[path] = "(no match)"
+            else:
+                cache[path] = match.view_name or match._func_path
+        return cache[path]
+    return resolver
+
+
+def timestamp(match, cache={}):
+    key = match.group(1, 2, 3, 4, 5, 6, 7, 8, 9)
+    if key not in cache:
+        if len(cache) > 1000:
+            cache.clear()
+        day, month, year, hour, minute, second, sign, off_h, off_m = key
+        seconds = calendar.timegm((int(year), months[month], int(day), int(hour),
+                                   int(minute), int(second), 0, 0, 0))
+        offset = (int(off_h) * 60 + int(off_m)) * 60
+        cache[key] = seconds - offset if sign == b"+" else seconds + offset
+    return cache[key]
+
+
+def main():
+    resolver = make_resolver()
+    overall = Stats()
+    patterns = {}
+    statuses = {}
+    first = last = None
+    for path in log_files():
+        log = open_log(path)
+        try:
+            for line in log:
+                match = line_re.match(line)
+                if not match:
+                    continue
+                when = timestamp(match)
+                if when < cutoff:
+                    continue
+                first = when if first is None else min(first, when)
+                last = when if last is None else max(last, when)
+                status = int(match.group(12))
+                ms = int(match.group(13)) / 1000
+                statuses[status] = statuses.get(status, 0) + 1
+                overall.add(ms, status)
+                pattern = "%s %s" % (match.group(10).decode("ascii", "replace"),
+                                     resolver(match.group(11)))
+                if pattern not in patterns:
+                    patterns[pattern] = Stats()
+                patterns[pattern].add(ms, status)
+        finally:
+            log.close()
+
+    if not overall.count:
+        print("No requests logged in the last %s hours." % hours)
+        return
+    span = max(last - first, 1)
+    print("%d requests in %.1f hours, %.2f requests/s" % (
+        overall.count, span / 3600, overall.count / span))
+    print("latency p50 %.0fms, p95 %.0fms, p99 %.0fms, max %.0fms" % (
+        overall.percentile(50), overall.percentile(95),
+        overall.percentile(99), overall.max_ms))
+    print("status " + ", ".join("%s: %.1f%%" % (code, hits * 100 / overall.count)
+                                for code, hits in sorted(statuses.items())))
+    print()
+    print("%-40s %8s %8s %8s %8s %8s %6s" % (
+        "slowest endpoints (by total time)", "requests", "req/s", "p50 ms",
+        "p95 ms", "p99 ms", "5xx"))
+    slowest = sorted(patterns.items(), key=lambda item: -item[1].total_ms)
+    for pattern, stats in slowest[:limit]:
+        print("%-40s %8d %8.2f %8.0f %8.0f %8.0f %6d" % (
+            pattern[:40], stats.count, stats.count / span,
+            stats.percentile(50), stats.percentile(95), stats.percentile(99),
+            stats.errors))
+
+
+main()
@@ -0,0 +1,17 @@
+"""
+Sets up Django for the scripts in this folder, which run from the project's
+directory on the server: uploaded there by the fabfile, or from the deployed
+copy of deploy/ when run by cron or supervisor.
+"""
+import os
+import sys
+
+
+def setup_django(proj_app):
+    """
+    Makes the project importable and sets up Django with its settings.
+    """
+    sys.path.insert(0, os.getcwd())
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "%s.settings" % proj_app)
+    import django
+    django.setup()
@@ -0,0 +1,154 @@
+"""
+Reports the health of the project's PostgreSQL database: table sizes,
+estimated bloat, dead rows, sequential versus index scans and tables that
+may be missing an index. Then runs VACUUM ANALYZE on the tables that need
+it most. Connects with the project's own database settings, so it can be
+run interactively by the dbmaint task or unattended as a cronjob.
+
+Usage: python dbmaint.py <project app> <limit> <vacuum: yes/no>
+"""
+from __future__ import division, print_function
+
+import sys
+import time
+
+from bootstrap import setup_django
+
+proj_app, limit, vacuum = sys.argv[1], int(sys.argv[2]), sys.argv[3] == "yes"
+setup_django(proj_app)
+from django.db import DatabaseError, connection  # noqa
+
+# Tables are vacuumed when they have this many dead rows, and at least this
+# fraction of their rows is dead.
+MIN_DEAD_ROWS = 1000
+MIN_DEAD_RATIO = 0.1
+
+TABLES_SQL = """
+SELECT relname,
+       pg_size_pretty(pg_total_relation_size(relid)),
+       n_live_tup,
+       n_dead_tup,
+       round(100.0 * n_dead_tup / greatest(n_live_tup + n_dead_tup, 1), 1),
+       seq_scan,
+       coalesce(idx_scan, 0),
+       round(100.0 * seq_scan / greatest(seq_scan + coalesce(idx_scan, 0), 1), 1),
+       greatest(last_vacuum, last_autovacuum)::date,
+       greatest(last_analyze, last_autoanalyze)::date
+FROM pg_stat_user_tables
+ORDER BY pg_total_relation_size(relid) DESC
+LIMIT %s
+"""
+
+# Compares the size of each table with the size its live rows should take,
+# using the average row width from the planner statistics.
+BLOAT_SQL = """
+WITH widths AS (
+    SELECT schemaname, tablename, sum(avg_width) + 24 AS row_width
+    FROM pg_stats
+    GROUP BY schemaname, tablename
+), sizes AS (
+    SELECT t.relname,
+           pg_relation_size(t.relid) AS size,
+           ceil(t.n_live_tup * w.row_width /
+                (current_setting('block_size')::int - 24)) *
+           current_setting('block_size')::int AS expected
+    FROM pg_stat_user_tables t
+    JOIN widths w ON w.schemaname = t.schemaname AND w.tablename = t.relname
+)
+SELECT relname,
+       pg_size_pretty(size),
+       pg_size_pretty(greatest(size - expected, 0)::bigint),
+       round(100.0 * greatest(size - expected, 0) / greatest(size, 1), 1)
+FROM sizes
+WHERE size > 0
+ORDER BY size - expected DESC
+LIMIT %s
+"""
+
+MISSING_INDEX_SQL = """
+SELECT relname,
+       n_live_tup,
+       seq_scan,
+       coalesce(idx_scan, 0),
+       seq_tup_read / greatest(seq_scan, 1)
+FROM pg_stat_user_tables
+WHERE seq_scan > coalesce(idx_scan, 0) AND n_live_tup > 1000
+ORDER BY seq_tup_read DESC
+LIMIT %s
+"""
+
+VACUUM_SQL = """
+SELECT relname
+FROM pg_stat_user_tables
+WHERE (n_dead_tup >= %s AND n_dead_tup >= %s * (n_live_tup + n_dead_tup))
+   OR (last_analyze IS NULL AND last_autoanalyze IS NULL AND n_live_tup > 0)
+ORDER BY n_dead_tup DESC
+LIMIT %s
+"""
+
+SLOW_QUERIES_SQL = """
+SELECT calls,
+       round(total_time::numeric / calls, 1),
+       round(total_time::numeric / 1000, 1),
+       regexp_replace(left(query, 80), '\\s+', ' ', 'g')
+FROM pg_stat_statements
+WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+ORDER BY total_time DESC
+LIMIT %s
+"""
+
+
+def report(title, headers, rows):
+    rows = [["" if v is None else str(v) for v in row] for row in rows]
+    widths = [max([len(h)] + [len(row[i]) for row in rows])
+              for i, h in enumerate(headers)]
+    line = lambda values: "  ".join(v.ljust(w) for v, w in zip(values, widths))
+    print(title)
+    print(line(headers))
+    print(line(["-" * w for w in widths]))
+    for row in rows:
+        print(line(row))
+    if not rows:
+        print("(none)")
+    print()
+
+
+def query(cursor, sql, *params):
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def main():
+    cursor = connection.cursor()
+    print("Database maintenance of %s, %s" % (
+        connection.settings_dict["NAME"], time.strftime("%Y-%m-%d %H:%M")))
+    print()
+    report("Largest tables", [
+        "table", "size", "live rows", "dead rows", "dead %", "seq scans",
+        "idx scans", "seq %", "vacuumed", "analyzed"],
+        query(cursor, TABLES_SQL, limit))
+    report("Estimated bloat", ["table", "size", "bloat", "bloat %"],
+           query(cursor, BLOAT_SQL, limit))
+    report("Tables that may be missing an index", [
+        "table", "live rows", "seq scans", "idx scans", "rows per seq scan"],
+        query(cursor, MISSING_INDEX_SQL, limit))
+    if query(cursor, "SELECT 1 FROM pg_extension "
+                     "WHERE extname = 'pg_stat_statements'"):
+        try:
+            report("Slowest queries", ["calls", "avg ms", "total s", "query"],
+                   query(cursor, SLOW_QUERIES_SQL, limit))
+        except DatabaseError as e:
+            print("Slowest queries not available: %s" % e)
+
+    if vacuum:
+        tables = [row[0] for row in query(cursor, VACUUM_SQL, MIN_DEAD_ROWS,
+                                          MIN_DEAD_RATIO, limit)]
+        if not tables:
+            print("No table needs to be vacuumed.")
+        for table in tables:
+            start = time.time()
+            cursor.execute("VACUUM ANALYZE %s" % connection.ops.quote_name(table))
+            print("VACUUM ANALYZE %s: %.1fs" % (table, time.time() - start))
+
+
+main()
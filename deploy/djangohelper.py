@@ -0,0 +1,58 @@
+"""
+Keeps Django loaded and runs the Python code and management commands sent
+as JSON lines through standard input, answering each one with a JSON line
+holding its output and exit status. Started by the fabfile when
+DJANGO_HELPER is enabled, it exits when its standard input is closed.
+
+Usage: python djangohelper.py <project app>
+"""
+from __future__ import print_function
+
+import json
+import sys
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from bootstrap import setup_django
+
+setup_django(sys.argv[1])
+from django.core.management import ManagementUtility  # noqa
+from django.db import close_old_connections  # noqa
+
+channel = sys.stdout
+
+
+def execute(request):
+    if "manage" in request:
+        ManagementUtility(["manage.py"] + request["manage"]).execute()
+    else:
+        code = compile(request["code"], "<fabfile>", "exec")
+        exec(code, {"__name__": "__main__"})
+
+
+for line in iter(sys.stdin.readline, ""):
+    request = json.loads(line)
+    output = StringIO()
+    sys.stdout = sys.stderr = output
+    status = 0
+    try:
+        execute(request)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = channel, sys.__stderr__
+        close_old_connections()
+    response = {"output": output.getvalue(), "status": status}
+    channel.write(json.dumps(response) + "\n")
+    channel.flush()
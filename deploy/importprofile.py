@@ -0,0 +1,77 @@
+"""
+Imports a module while timing every import it triggers, then prints the
+total time and the slowest modules.
+
+Usage: python importprofile.py <module> <limit>
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+sys.path.insert(0, os.getcwd())
+module, limit = sys.argv[1], int(sys.argv[2])
+real_import = builtins.__import__
+stats = {}
+stack = []
+
+
+def absolute_name(name, globals, level):
+    """
+    Returns the full name of a module imported relatively to another one.
+    """
+    if level <= 0 or not globals:
+        return name
+    package = globals.get("__package__")
+    if not package:
+        package = globals.get("__name__", "")
+        if "__path__" not in globals:
+            package = package.rpartition(".")[0]
+    package = package.rsplit(".", level - 1)[0]
+    return "%s.%s" % (package, name) if name else package
+
+
+def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # from pkg import submodule loads the submodule even when pkg is loaded
+    base = absolute_name(name, globals, level)
+    targets = [base] + ["%s.%s" % (base, item) for item in fromlist or ()
+                        if item != "*"]
+    missing = [target for target in targets if target not in sys.modules]
+    if not missing:
+        return real_import(name, globals, locals, fromlist, level)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return real_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        children = stack.pop()
+        # Names in fromlist may be attributes rather than submodules, only
+        # what actually got loaded is recorded
+        loaded = [target for target in missing if target in sys.modules]
+        if loaded:
+            if stack:
+                stack[-1] += elapsed
+            key = ", ".join(loaded)
+            cumulative, own = stats.get(key, (0.0, 0.0))
+            stats[key] = (cumulative + elapsed, own + elapsed - children)
+        elif stack:
+            stack[-1] += children
+
+
+builtins.__import__ = timed_import
+start = time.time()
+__import__(module)
+total = time.time() - start
+builtins.__import__ = real_import
+
+print("total %.1f ms, %d modules" % (total * 1000, len(stats)))
+slowest = sorted(stats.items(), key=lambda item: -item[1][1])[:limit]
+for name, (cumulative, own) in slowest:
+    print("%10.1f %10.1f  %s" % (own * 1000, cumulative * 1000, name))
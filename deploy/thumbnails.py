@@ -0,0 +1,148 @@
+"""
+Generates the Mezzanine thumbnails of the uploaded images ahead of time, so
+gunicorn workers don't have to on the first page views. Thumbnail sizes are
+taken from the {% thumbnail %} tags in the project's templates, unless given.
+Only images that are new or changed since the last run are processed, with a
+pool of processes.
+
+Usage: python thumbnails.py <project app> <jobs> <sizes: WxH,... or auto>
+"""
+from __future__ import division, print_function
+
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from multiprocessing import Pool
+
+from bootstrap import setup_django
+
+proj_app, jobs, sizes_arg = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+setup_django(proj_app)
+from django.apps import apps  # noqa
+from django.conf import settings  # noqa
+from mezzanine.core.templatetags.mezzanine_tags import thumbnail  # noqa
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+MANIFEST_PATH = os.path.join(settings.MEDIA_ROOT, ".thumbnails.json")
+
+# Width and height of the tag, followed by the literal optional arguments
+# (upscale, quality, left, top, padding, padding_color) it may have.
+tag_re = re.compile(r"{%\s*thumbnail\s+\S+\s+(\d+)\s+(\d+)((?:\s+[^\s%]+)*)\s*%}")
+literals = {"True": True, "False": False}
+
+
+def parse_arg(arg):
+    if arg in literals:
+        return literals[arg]
+    if arg[0] in ("'", '"') and arg[-1] == arg[0]:
+        return arg[1:-1]
+    return float(arg) if "." in arg else int(arg)
+
+
+def template_dirs():
+    dirs = []
+    for engine in getattr(settings, "TEMPLATES", []):
+        dirs.extend(engine.get("DIRS", []))
+    dirs.extend(getattr(settings, "TEMPLATE_DIRS", []))
+    for app in apps.get_app_configs():
+        dirs.append(os.path.join(app.path, "templates"))
+    return [d for d in dirs if os.path.isdir(d)]
+
+
+def template_sizes():
+    """
+    The sets of thumbnail arguments used by every {% thumbnail %} tag.
+    """
+    sizes = set()
+    for directory in template_dirs():
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for name in filenames:
+                with open(os.path.join(dirpath, name), "rb") as f:
+                    source = f.read().decode("utf-8", "replace")
+                for width, height, extra in tag_re.findall(source):
+                    try:
+                        extra = tuple(parse_arg(arg) for arg in extra.split())
+                    except ValueError:
+                        # Arguments are template variables, use the defaults
+                        extra = ()
+                    sizes.add((int(width), int(height)) + extra)
+    return sorted(sizes)
+
+
+def parse_sizes(arg):
+    return [tuple(int(n) for n in size.split("x")) for size in arg.split(",")]
+
+
+def media_images():
+    """
+    The images in MEDIA_ROOT, relative to it, with their modification
+    time and size.
+    """
+    images = {}
+    for dirpath, dirnames, filenames in os.walk(settings.MEDIA_ROOT):
+        dirnames[:] = [d for d in dirnames if d != settings.THUMBNAILS_DIR_NAME]
+        for name in filenames:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                rel_path = os.path.relpath(path, settings.MEDIA_ROOT)
+                images[rel_path] = [int(stat.st_mtime), stat.st_size]
+    return images
+
+
+def generate(task):
+    image, sizes = task
+    for size in sizes:
+        thumbnail(image, *size)
+    return image
+
+
+def main():
+    sizes = template_sizes() if sizes_arg == "auto" else parse_sizes(sizes_arg)
+    if not sizes:
+        print("No thumbnail sizes found in the templates.")
+        return
+    print("Thumbnail sizes: %s" % ", ".join(
+        "x".join(str(n) for n in size[:2]) for size in sizes))
+    try:
+        with open(MANIFEST_PATH, "r") as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {"sizes": [], "images": {}}
+    images = media_images()
+    sizes_changed = [list(size) for size in sizes] != manifest["sizes"]
+    changed = [image for image, stat in images.items()
+               if manifest["images"].get(image) != stat]
+    pending = sorted(images) if sizes_changed else sorted(changed)
+
+    # Thumbnails of changed images are stale, they would never be regenerated
+    for image in changed:
+        image_dir, image_name = os.path.split(image)
+        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, image_dir,
+                                   settings.THUMBNAILS_DIR_NAME, image_name),
+                      ignore_errors=True)
+
+    print("%d images, %d to process with %d processes" % (
+        len(images), len(pending), jobs))
+    start = time.time()
+    pool = Pool(jobs)
+    try:
+        tasks = [(image, sizes) for image in pending]
+        for done, image in enumerate(pool.imap_unordered(generate, tasks), 1):
+            if done % 50 == 0 or done == len(pending):
+                elapsed = time.time() - start
+                print("%d/%d images, %.1fs, %.1f images/s" % (
+                    done, len(pending), elapsed, done / max(elapsed, 0.001)))
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump({"sizes": [list(size) for size in sizes], "images": images}, f)
+    print("Done in %.1fs" % (time.time() - start))
+
+
+main()
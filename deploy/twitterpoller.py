@@ -0,0 +1,66 @@
+"""
+Polls Twitter for the queries used in the templates every period, like
+Mezzanine's poll_twitter command, but staying resident so Django is only
+loaded once. When the Twitter API fails, waits longer before the next poll.
+Run by supervisor when TWITTER_MODE is "supervisor".
+
+Usage: python twitterpoller.py <project app> <period in minutes>
+"""
+from __future__ import print_function
+
+import signal
+import sys
+import time
+import traceback
+
+from bootstrap import setup_django
+
+proj_app, period = sys.argv[1], int(sys.argv[2])
+setup_django(proj_app)
+from django.db import close_old_connections  # noqa
+from mezzanine.twitter.models import Query, TwitterQueryException  # noqa
+
+# Longest wait between polls after repeated errors, in periods
+MAX_BACKOFF = 8
+
+
+def log(message):
+    print("[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message))
+
+
+def poll():
+    """
+    Runs every query in use, returning the number of failed ones.
+    """
+    errors = 0
+    for query in Query.objects.filter(interested=True):
+        try:
+            query.run()
+        except TwitterQueryException as e:
+            errors += 1
+            log("Twitter query error [%s]: %s" % (query, e))
+    return errors
+
+
+def main():
+    # Let supervisor stop the poller cleanly, even while sleeping
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log("Polling Twitter every %s minutes" % period)
+    backoff = 1
+    while True:
+        try:
+            failed = poll() > 0
+        except Exception:
+            traceback.print_exc()
+            failed = True
+        finally:
+            close_old_connections()
+        if failed:
+            backoff = min(backoff * 2, MAX_BACKOFF)
+            log("Backing off, next poll in %s minutes" % (period * backoff))
+        else:
+            backoff = 1
+        time.sleep(period * 60 * backoff)
+
+
+main()
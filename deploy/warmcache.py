@@ -0,0 +1,27 @@
+"""
+Requests the given pages through Django's middleware with the settings just
+deployed, so they are stored in the page cache under the new release's key
+prefix before gunicorn is restarted.
+
+Usage: python warmcache.py <project app> <host> <url> [<url> ...]
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from bootstrap import setup_django
+
+proj_app, host, urls = sys.argv[1], sys.argv[2], sys.argv[3:]
+setup_django(proj_app)
+from django.conf import settings  # noqa
+from django.test import Client  # noqa
+
+client = Client(HTTP_HOST=host)
+print("Warming the page cache with prefix %s" %
+      settings.CACHE_MIDDLEWARE_KEY_PREFIX)
+for url in urls:
+    start = time.time()
+    response = client.get(url)
+    print("%s %s %.0fms" % (response.status_code, url,
+                            (time.time() - start) * 1000))
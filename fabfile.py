@@ -1,23 +1,37 @@
 from __future__ import print_function, unicode_literals
 from future.builtins import open
 
+import hashlib
+import json
+import multiprocessing
 import os
 import re
+import shlex
 import sys
-import tempfile
+import time
+from fnmatch import fnmatch
 from contextlib import contextmanager
 from functools import wraps
 from getpass import getpass, getuser
 from importlib import import_module
+from io import BytesIO
 from posixpath import join
 
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
+
 from mezzanine.utils.conf import real_project_name
 
-from fabric.api import abort, env, cd, get, prefix, run as _run, hide, task, local
-from fabric.context_managers import settings as fab_settings
+from fabric.api import abort, env, cd, prefix, run as _run, hide, local, put
+from fabric.api import task as fabric_task
+from fabric.context_managers import settings as fab_settings, shell_env
 from fabric.contrib.console import confirm
 from fabric.contrib.files import exists, upload_template
 from fabric.contrib.project import rsync_project
+from fabric.operations import _AttributeString
+from fabric.state import connections, output as fab_output
 from fabric.colors import yellow, green, blue, red
 
 
@@ -56,6 +70,9 @@ env.proj_name = conf.get("PROJECT_NAME", env.proj_app)
 env.venv_home = "/home/%s/.virtualenvs" % env.user
 env.venv_path = join(env.venv_home, env.proj_name)
 env.proj_path = "/home/%s/webapps/%s" % (env.user, env.proj_name)
+env.last_db = "%s.last.db" % env.proj_path
+env.scripts_path = "/home/%s/tmp/%s_scripts" % (env.user, env.proj_name)
+env.pgpass_path = "/home/%s/.%s.pgpass" % (env.user, env.proj_name)
 env.manage = "%s/bin/python %s/manage.py" % (env.venv_path, env.proj_path)
 env.domains = conf.get("DOMAINS", env.live_host)
 env.domains_python = ", ".join(["'%s'" % s for s in env.domains])
@@ -64,8 +81,20 @@ env.deploy_tool = conf.get("DEPLOY_TOOL", "rsync")
 env.reqs_path = conf.get("REQUIREMENTS_PATH", None)
 env.locale = conf.get("LOCALE", "en_US.UTF-8")
 env.twitter_period = conf.get("TWITTER_PERIOD", None)
+env.twitter_mode = conf.get("TWITTER_MODE", "cron")
 env.num_workers = conf.get("NUM_WORKERS",
                            "multiprocessing.cpu_count() * 2 + 1")
+env.compile_jobs = conf.get("COMPILE_JOBS", 4)
+env.deploy_jobs = conf.get("DEPLOY_JOBS", 4)
+env.access_log = "/home/%s/logs/user/%s_access.log" % (env.user, env.proj_name)
+env.use_access_log = "" if conf.get("ACCESS_LOG", False) else "#"
+env.django_helper = conf.get("DJANGO_HELPER", False)
+env.dbmaint_schedule = conf.get("DBMAINT_SCHEDULE", None)
+env.thumbnails = conf.get("THUMBNAILS", False)
+env.thumbnail_jobs = conf.get("THUMBNAIL_JOBS", 2)
+env.cache_warm_urls = conf.get("CACHE_WARM_URLS", ["/"])
+env.cache_release = None
+env.webf_api_url = "https://api.webfaction.com/"
 
 env.secret_key = conf.get("SECRET_KEY", "")
 env.nevercache_key = conf.get("NEVERCACHE_KEY", "")
@@ -109,6 +138,14 @@ templates = {
     },
 }
 
+# A resident Twitter poller replaces the cronjob if requested
+if env.twitter_mode == "supervisor" and isinstance(env.twitter_period, int):
+    templates["twitter"] = {
+        "local_path": "deploy/twitter.conf.template",
+        "remote_path": "/home/%(user)s/etc/supervisor/conf.d/%(proj_name)s_twitter.conf",
+        "reload_command": "supervisorctl update twitter_%(proj_name)s",
+    }
+
 
 ###################################
 # Wrappers for the Webfaction API #
@@ -120,7 +157,7 @@ def get_webf_session():
     to make further API calls.
     """
     import xmlrpclib
-    server = xmlrpclib.ServerProxy("https://api.webfaction.com/")
+    server = xmlrpclib.ServerProxy(env.webf_api_url)
     print("Logging in to Webfaction as %s." % env.user)
     if env.password is None:
         env.password = getpass(
@@ -199,23 +236,57 @@ def update_changed_requirements():
     yield
     if old_reqs:
         new_reqs = get_reqs()
-        if old_reqs == new_reqs:
-            # Unpinned requirements should always be checked.
-            for req in new_reqs.split("\n"):
-                if req.startswith("-e"):
-                    if "@" not in req:
-                        # Editable requirement without pinned commit.
-                        break
-                elif req.strip() and not req.startswith("#"):
-                    if not set(">=<") & set(req):
-                        # PyPI requirement without version.
-                        break
-            else:
-                # All requirements are pinned.
-                return
+        if old_reqs == new_reqs and not has_unpinned_requirements(new_reqs):
+            return
         pip("-r %s/%s" % (env.proj_path, env.reqs_path))
 
 
+def has_unpinned_requirements(reqs):
+    """
+    Checks if a requirements file contains any unpinned requirement.
+    Unpinned requirements should always be checked.
+    """
+    for req in reqs.split("\n"):
+        if req.startswith("-e"):
+            if "@" not in req:
+                # Editable requirement without pinned commit.
+                return True
+        elif req.strip() and not req.startswith("#"):
+            if not set(">=<") & set(req):
+                # PyPI requirement without version.
+                return True
+    # All requirements are pinned.
+    return False
+
+
+# Hosts where the remote database password file was written in this run
+pgpass_written = set()
+
+
+@contextmanager
+def remote_db_password():
+    """
+    Passes the remote database password to PostgreSQL commands if it's
+    known, otherwise they will prompt for it. The password is written to a
+    private password file, since other users of the server can see command
+    lines and their environment.
+    """
+    if env.db_pass:
+        if env.host_string not in pgpass_written:
+            password = re.sub(r"([\\:])", r"\\\1", env.db_pass)
+            entry = "*:*:%s:%s:%s\n" % (env.proj_name, env.proj_name, password)
+            run("umask 077 && touch %s" % env.pgpass_path, show=False)
+            with hide("running"):
+                put(BytesIO(entry.encode("utf-8")), env.pgpass_path, mode=0o600)
+            pgpass_written.add(env.host_string)
+        with shell_env(PGPASSFILE=env.pgpass_path):
+            yield
+    else:
+        print(blue("Input the remote database password when prompted",
+                   bold=True))
+        yield
+
+
 ###########################################
 # Utils and wrappers for various commands #
 ###########################################
@@ -232,6 +303,22 @@ def print_command(command):
            red(" ->", bold=True))
 
 
+def task(func):
+    """
+    Declares a Fabric task. When the task run from the command line returns,
+    the persistent Django processes are stopped while Fabric is still
+    connected.
+    """
+    @wraps(func)
+    def stopping_helpers(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if func.__name__ == env.command:
+                stop_django_helpers()
+    return fabric_task(stopping_helpers)
+
+
 @task
 def run(command, show=True, *args, **kwargs):
     """
@@ -243,6 +330,13 @@ def run(command, show=True, *args, **kwargs):
         return _run(command, *args, **kwargs)
 
 
+def as_bool(value):
+    """
+    Converts a task argument, which Fabric passes as a string, to a boolean.
+    """
+    return str(value).lower() in ("true", "yes", "y", "1")
+
+
 def log_call(func):
     @wraps(func)
     def logged(*args, **kawrgs):
@@ -262,32 +356,53 @@ def get_templates():
     return injected
 
 
+def deploy_file(local_path):
+    """
+    Returns the path of a file shipped in deploy/, looking next to the
+    fabfile if it's not found in the current dir.
+    """
+    if not os.path.exists(local_path):
+        project_root = os.path.dirname(os.path.abspath(__file__))
+        local_path = os.path.join(project_root, local_path)
+    return local_path
+
+
+def render_template(name):
+    """
+    Returns the local path of a template and its contents with env vars
+    injected.
+    """
+    local_path = deploy_file(get_templates()[name]["local_path"])
+    with open(local_path, "r") as f:
+        local_data = f.read()
+        # Escape all non-string-formatting-placeholder occurrences of '%',
+        # leaving the ones already escaped as they are:
+        local_data = re.sub(r"%%|%(?!\(\w+\)s)", "%%", local_data)
+        if "%(db_pass)s" in local_data:
+            env.db_pass = db_pass()
+        if "%(cache_release)s" in local_data and not env.cache_release:
+            env.cache_release = release_id()
+        local_data %= env
+    return local_path, local_data
+
+
 def upload_template_and_reload(name):
     """
     Uploads a template only if it has changed, and if so, reload the
     related service.
     """
     template = get_templates()[name]
-    local_path = template["local_path"]
-    if not os.path.exists(local_path):
-        project_root = os.path.dirname(os.path.abspath(__file__))
-        local_path = os.path.join(project_root, local_path)
     remote_path = template["remote_path"]
     reload_command = template.get("reload_command")
     remote_data = ""
     if exists(remote_path):
         with hide("stdout"):
             remote_data = run("cat %s" % remote_path, show=False)
-    with open(local_path, "r") as f:
-        local_data = f.read()
-        # Escape all non-string-formatting-placeholder occurrences of '%':
-        local_data = re.sub(r"%(?!\(\w+\)s)", "%%", local_data)
-        if "%(db_pass)s" in local_data:
-            env.db_pass = db_pass()
-        local_data %= env
+    local_path, local_data = render_template(name)
     clean = lambda s: s.replace("\n", "").replace("\r", "").strip()
     if clean(remote_data) == clean(local_data):
         return
+    stop_django_helper()
     upload_template(local_path, remote_path, env, use_sudo=False, backup=False)
     if reload_command:
         run(reload_command)
@@ -306,21 +421,27 @@ def cpmedia(upload=True):
                   upload=upload)
 
 
+# Files and folders never uploaded by rsync_upload()
+rsync_excludes = ["*.pyc", "*.pyo", "*.db", ".DS_Store", ".coverage",
+                  "local_settings.py", "/static", "/.git", "/.hg",
+                  "/.deploy_timings.json"]
+
+
 def rsync_upload():
     """
     Uploads the project with rsync excluding some files and folders.
     """
-    excludes = ["*.pyc", "*.pyo", "*.db", ".DS_Store", ".coverage",
-                "local_settings.py", "/static", "/.git", "/.hg"]
+    stop_django_helper()
     local_dir = os.getcwd() + os.sep
     return rsync_project(remote_dir=env.proj_path, local_dir=local_dir,
-                         exclude=excludes)
+                         exclude=rsync_excludes)
 
 
 def vcs_upload():
     """
     Uploads the project with the selected VCS tool.
     """
+    stop_django_helper()
     if env.deploy_tool == "git":
         remote_path = "ssh://%s@%s%s" % (env.user, env.host_string,
                                          env.repo_path)
@@ -362,6 +483,7 @@ def pip(packages, show=True):
     Install Python packages within the virtual environment.
     """
     # We use our own tmp folder to avoid problems with the system /tmp.
+    stop_django_helper()
     pip_tmp = "/home/%s/tmp/pip" % env.user
     if not exists(pip_tmp):
         run("mkdir -p %s" % pip_tmp)
@@ -375,9 +497,9 @@ def backup(filename):
     """
     Backs up the remote (production) database.
     """
-    print(blue("Input the remote database password when prompted", bold=True))
-    return run("pg_dump -U %s -Fc %s > %s" % (
-        env.proj_name, env.proj_name, filename))
+    with remote_db_password():
+        return run("pg_dump -U %s -Fc %s > %s" % (
+            env.proj_name, env.proj_name, filename))
 
 
 @task
@@ -395,9 +517,9 @@ def restore(filename):
     """
     Restores the remote (production) database from a previous backup.
     """
-    print(blue("Input the remote database password when prompted", bold=True))
-    return run("pg_restore -U %s -c -d %s %s" % (
-        env.proj_name, env.proj_name, filename))
+    with remote_db_password():
+        return run("pg_restore -U %s -c -d %s %s" % (
+            env.proj_name, env.proj_name, filename))
 
 
 @task
@@ -415,6 +537,10 @@ def python(code, show=True):
     """
     Runs Python code in the project's virtual environment, with Django loaded.
     """
+    if env.django_helper:
+        if show:
+            print_command(code)
+        return django_helper_call({"code": code})
     setup = "import os;" \
             "os.environ[\'DJANGO_SETTINGS_MODULE\']=\'%s.settings\';" \
             "import django;" \
@@ -427,6 +553,39 @@ def python(code, show=True):
     return result
 
 
+# Scripts from deploy/ already uploaded to the server, by host
+uploaded_scripts = {}
+
+
+def upload_script(local_path):
+    """
+    Uploads a script shipped in deploy/ to the server, as is, along with the
+    module setting up Django for it, and returns its remote path. Each file
+    is only uploaded once per run.
+    """
+    uploaded = uploaded_scripts.setdefault(env.host_string, set())
+    if not uploaded:
+        run("mkdir -p %s" % env.scripts_path, show=False)
+    for path in (local_path, "deploy/bootstrap.py"):
+        if path not in uploaded:
+            with hide("running"):
+                put(deploy_file(path), join(env.scripts_path, os.path.basename(path)))
+            uploaded.add(path)
+    return join(env.scripts_path, os.path.basename(local_path))
+
+
+def python_script(local_path, args="", show=True):
+    """
+    Runs a local Python script in the project's virtual environment, after
+    uploading it to the server.
+    """
+    remote_path = upload_script(local_path)
+    with project():
+        if show:
+            print_command("python %s %s" % (os.path.basename(local_path), args))
+        return run("python %s %s" % (remote_path, args), show=False)
+
+
 def static():
     """
     Returns the live STATIC_ROOT directory.
@@ -440,9 +599,85 @@ def manage(command):
     """
     Runs a Django management command.
     """
+    if env.django_helper:
+        print_command("%s %s" % (env.manage, command))
+        return django_helper_call({"manage": shlex.split(command)})
     return run("%s %s" % (env.manage, command))
 
 
+# Remote Django processes started by the persistent helper, by host
+django_helpers = {}
+
+
+def start_django_helper():
+    """
+    Returns the channel and files of the persistent Django process for the
+    current host, starting it if needed. Django is set up only once, and
+    every python() and manage() call is sent to it through the SSH channel.
+    """
+    if env.host_string not in django_helpers:
+        command = "cd %s && %s/bin/python -u %s %s" % (
+            env.proj_path, env.venv_path, upload_script("deploy/djangohelper.py"),
+            env.proj_app)
+        channel = connections[env.host_string].get_transport().open_session()
+        channel.exec_command(command)
+        django_helpers[env.host_string] = (
+            channel, channel.makefile("wb"), channel.makefile("rb"))
+    return django_helpers[env.host_string]
+
+
+def stop_django_helper():
+    """
+    Stops the persistent Django process for the current host, which exits
+    as soon as its standard input is closed. It will be started again with
+    fresh code when needed.
+    """
+    helper = django_helpers.pop(env.host_string, None)
+    if helper:
+        channel = helper[0]
+        channel.shutdown_write()
+        channel.recv_exit_status()
+        channel.close()
+
+
+def stop_django_helpers():
+    """
+    Stops the persistent Django processes left at the end of a task.
+    """
+    for host_string in list(django_helpers):
+        with fab_settings(host_string=host_string):
+            stop_django_helper()
+
+
+def django_helper_call(request):
+    """
+    Sends a request to the persistent Django process and returns its output.
+    Like run(), aborts if the request fails, unless warn_only is set.
+    """
+    channel, stdin, stdout = start_django_helper()
+    stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+    stdin.flush()
+    line = stdout.readline()
+    if not line:
+        error = channel.makefile_stderr("rb").read().decode("utf-8", "replace")
+        django_helpers.pop(env.host_string, None)
+        abort("The Django helper exited unexpectedly:\n%s" % error)
+    response = json.loads(line.decode("utf-8"))
+    output = response["output"].strip()
+    if not isinstance(output, str):
+        output = output.encode("utf-8")
+    if output and fab_output.stdout:
+        print(output)
+    result = _AttributeString(output)
+    result.return_code = response["status"]
+    result.failed = result.return_code != 0
+    result.succeeded = not result.failed
+    result.stderr = ""
+    if result.failed and not env.warn_only:
+        abort("Remote Django command failed:\n%s" % output)
+    return result
+
+
 #########################
 # Install and configure #
 #########################
@@ -596,6 +831,7 @@ def remove():
     """
     Blow away the current project.
     """
+    from xmlrpclib import Fault
     # Delete Webfaction API objects
     _print(blue("Removing database and website records from the Webfaction "
                 "control panel...", bold=True))
@@ -618,15 +854,27 @@ def remove():
     db_user = get_webf_obj(srv, ssn, "db_user", env.proj_name)
     if db_user:
         del_webf_obj(srv, ssn, "db_user", env.proj_name, "postgresql")
-    if isinstance(env.twitter_period, int):
+    if isinstance(env.twitter_period, int) and env.twitter_mode == "cron":
         srv.delete_cronjob(ssn, "*/%s * * * * %s poll_twitter" % (
             env.twitter_period, env.manage))
+    if env.dbmaint_schedule:
+        # Only registered if dbmaint:cron=True was run
+        try:
+            srv.delete_cronjob(ssn, dbmaint_cronjob())
+        except Fault as e:
+            print(yellow("Couldn't delete the database maintenance cronjob (%s), "
+                         "delete it from the control panel if it's there:\n%s"
+                         % (e.faultString, dbmaint_cronjob()), bold=True))
 
     # Delete files/folders
     if exists(env.venv_path):
         run("rm -rf %s" % env.venv_path)
     if exists(env.repo_path):
         run("rm -rf %s" % env.repo_path)
+    if exists(env.scripts_path):
+        run("rm -rf %s" % env.scripts_path)
+    if exists(env.pgpass_path):
+        run("rm %s" % env.pgpass_path)
     for template in get_templates().values():
         remote_path = template["remote_path"]
         if exists(remote_path):
@@ -636,6 +884,306 @@ def remove():
     run("supervisorctl update")
 
 
+###################
+# Deploy planning #
+###################
+
+# Stages run by deploy(), in order. Each deploy only runs the stages that
+# plan_deploy() finds necessary after comparing the remote and local state.
+deploy_stages = ["backup", "snapshot", "statictar", "upload", "requirements",
+                 "static", "migrate", "templates", "compile", "warmcache",
+                 "restart", "thumbnails"]
+
+# Stages that must finish before each stage starts, if they're planned.
+# Stages not depending on each other run at the same time.
+deploy_dependencies = {
+    "backup": [],
+    "snapshot": [],
+    "statictar": [],
+    "upload": ["snapshot"],
+    "requirements": ["upload"],
+    "static": ["statictar", "upload", "requirements"],
+    "migrate": ["backup", "upload", "requirements"],
+    "templates": ["upload", "requirements", "static", "migrate"],
+    "compile": ["upload", "requirements"],
+    "warmcache": ["templates", "compile"],
+    "restart": ["static", "migrate", "templates", "compile", "warmcache"],
+    "thumbnails": ["upload", "requirements", "restart"],
+}
+
+# Stages the site works without, so the deploy carries on if they fail
+deploy_best_effort = ["thumbnails"]
+
+# Local file holding the durations of past deploy stages
+timings_path = ".deploy_timings.json"
+
+
+def deploy_state_path():
+    """
+    Returns the remote file recording the state of the last deploy.
+    """
+    return "%s/.deploy_state" % env.proj_path
+
+
+def snapshot_path():
+    """
+    Returns the remote file holding the version of the project saved by the
+    last deploy, which rollback restores.
+    """
+    if env.deploy_tool == "git":
+        return "%s/last.commit" % env.proj_path
+    elif env.deploy_tool == "hg":
+        return "%s/last.commit" % env.repo_path
+    return "%s.tar" % env.proj_path
+
+
+def md5(data):
+    """
+    Returns the md5 hex digest of a string.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return hashlib.md5(data).hexdigest()
+
+
+def is_excluded(path, excludes):
+    """
+    Checks a project relative path against rsync-style exclude patterns.
+    Patterns starting with a slash are anchored to the project root.
+    """
+    parts = path.split("/")
+    for pattern in excludes:
+        if pattern.startswith("/"):
+            if fnmatch(parts[0], pattern[1:]):
+                return True
+        elif any(fnmatch(part, pattern) for part in parts):
+            return True
+    return False
+
+
+def local_files():
+    """
+    Returns a sorted list of (path, content id) pairs for the files that
+    would be uploaded by the selected deploy tool.
+    """
+    files = []
+    if env.deploy_tool == "git":
+        for line in local("git ls-tree -r master", capture=True).splitlines():
+            info, path = line.split("\t", 1)
+            files.append((path, info.split()[2]))
+    elif env.deploy_tool == "hg":
+        for line in local("hg manifest --debug", capture=True).splitlines():
+            # <node> <mode> <flag> <path>, the flag being * (executable), @
+            # (symlink) or a blank
+            node, mode, rest = line.split(" ", 2)
+            files.append((rest[2:], node))
+    else:
+        root = os.getcwd()
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel_dir = os.path.relpath(dirpath, root).replace(os.sep, "/")
+            rel_dir = "" if rel_dir == "." else rel_dir + "/"
+            dirnames[:] = [d for d in dirnames
+                           if not is_excluded(rel_dir + d, rsync_excludes)]
+            for name in filenames:
+                path = rel_dir + name
+                if not is_excluded(path, rsync_excludes):
+                    with open(os.path.join(dirpath, name), "rb") as f:
+                        files.append((path, md5(f.read())))
+    return sorted(files)
+
+
+def release_id():
+    """
+    Returns the id of the local version of the project, which prefixes the
+    keys of the pages it caches: its commit with version control, or a digest
+    of its files with rsync.
+    """
+    if env.deploy_tool == "git":
+        release = local("git rev-parse master", capture=True)
+    elif env.deploy_tool == "hg":
+        release = local("hg id -i", capture=True)
+    else:
+        release = md5("\n".join("%s %s" % item for item in local_files()))
+    return release.strip()[:8]
+
+
+def local_state():
+    """
+    Returns the state of the local project, to be compared with the state
+    of the deployed one.
+    """
+    files = local_files()
+    digest = lambda items: md5("\n".join("%s %s" % item for item in items))
+    state = {
+        "code": digest(files),
+        "static": digest([(p, c) for p, c in files
+                          if "/static/" in p and not p.startswith("static/")]),
+        "migrations": digest([(p, c) for p, c in files
+                              if "/migrations/" in p and p.endswith(".py")]),
+        "reqs": "",
+    }
+    if env.deploy_tool == "git":
+        state["commit"] = local("git rev-parse master", capture=True).strip()
+    elif env.deploy_tool == "hg":
+        state["commit"] = local("hg id -i", capture=True).strip()
+    if env.reqs_path and os.path.exists(env.reqs_path):
+        with open(env.reqs_path, "rb") as f:
+            state["reqs_data"] = f.read().decode("utf-8")
+        state["reqs"] = md5(state["reqs_data"])
+    for name in get_templates():
+        state["template_%s" % name] = md5(render_template(name)[1])
+    return state
+
+
+def remote_state():
+    """
+    Gathers the state of the deployed project in a single remote call:
+    current commit, requirements hash, the static and migration manifests
+    recorded by the last deploy, template hashes, and process status.
+    """
+    checksum = "$(md5sum < %s 2>/dev/null | cut -c1-32)"
+    commands = [
+        "cat %s 2>/dev/null" % deploy_state_path(),
+        "echo port=$(cat %s/app.port 2>/dev/null)" % env.proj_path,
+        "echo running=$(supervisorctl status gunicorn_%s 2>/dev/null "
+        "| grep -c RUNNING)" % env.proj_name,
+    ]
+    if env.deploy_tool == "git":
+        # HEAD is the checked out commit, which is master's unless rolled back
+        commands.append("echo commit=$(git --git-dir=%s rev-parse HEAD "
+                        "2>/dev/null)" % env.repo_path)
+    elif env.deploy_tool == "hg":
+        commands.append("echo commit=$(hg id -i -R %s 2>/dev/null)" %
+                        env.repo_path)
+    if env.reqs_path:
+        commands.append("echo reqs=" + checksum % join(env.proj_path,
+                                                       env.reqs_path))
+    for name, template in get_templates().items():
+        commands.append("echo template_%s=%s" % (
+            name, checksum % template["remote_path"]))
+    with fab_settings(hide("stdout"), warn_only=True):
+        output = run("; ".join(commands), show=False)
+    state = {}
+    for line in output.splitlines():
+        key, sep, value = line.strip().partition("=")
+        if sep:
+            state[key] = value
+    return state
+
+
+def load_timings():
+    """
+    Returns the durations of past deploy stages, in seconds.
+    """
+    try:
+        with open(timings_path, "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_timing(stage, seconds, keep=5):
+    """
+    Records the duration of a deploy stage, keeping only the latest runs.
+    """
+    timings = load_timings()
+    timings[stage] = (timings.get(stage, []) + [round(seconds, 1)])[-keep:]
+    with open(timings_path, "w") as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+
+
+def estimate(stage, timings):
+    """
+    Returns a printable duration estimate for a stage based on past runs.
+    """
+    runs = timings.get(stage)
+    if not runs:
+        return "?"
+    return "~%ss" % int(round(sum(runs) / len(runs)))
+
+
+def plan_deploy(full=False):
+    """
+    Compares the remote state with the local project and returns a list of
+    (stage, reason) pairs for the stages a deploy needs to run.
+    """
+    remote = remote_state()
+    env.gunicorn_port = remote.get("port", "")
+    env.local_state = local_state()
+    lcl = env.local_state
+    if full:
+        env.stale_templates = list(get_templates())
+        optional = {"statictar": env.deploy_tool in env.vcs_tools,
+                    "requirements": env.reqs_path, "warmcache": env.cache_warm_urls,
+                    "thumbnails": env.thumbnails}
+        return [(stage, "full deploy requested") for stage in deploy_stages
+                if optional.get(stage, True)]
+
+    needed = {}
+    code_key = "commit" if env.deploy_tool in env.vcs_tools else "code"
+    if lcl[code_key] != remote.get(code_key):
+        needed["upload"] = "code changed"
+        needed["snapshot"] = "keep the current version for rollback"
+        if env.deploy_tool in env.vcs_tools:
+            needed["statictar"] = "keep the current static files for rollback"
+        if env.reqs_path and lcl["reqs"] != remote.get("reqs"):
+            needed["requirements"] = "requirements changed"
+        elif env.reqs_path and has_unpinned_requirements(lcl.get("reqs_data", "")):
+            needed["requirements"] = "unpinned requirements"
+    if lcl["static"] != remote.get("static"):
+        needed["static"] = "static files changed"
+    elif "requirements" in needed:
+        needed["static"] = "packages may ship new static files"
+    if lcl["migrations"] != remote.get("migrations"):
+        needed["migrate"] = "migrations changed"
+    elif "requirements" in needed:
+        needed["migrate"] = "packages may ship new migrations"
+    if "migrate" in needed:
+        needed["backup"] = "the database schema may change"
+    env.stale_templates = [name for name in get_templates()
+                           if lcl["template_%s" % name] !=
+                           remote.get("template_%s" % name)]
+    if env.stale_templates:
+        needed["templates"] = ", ".join(sorted(env.stale_templates)) + " changed"
+    if set(needed) & set(["upload", "requirements"]):
+        needed["compile"] = "new code has no bytecode yet"
+    if "settings" in env.stale_templates and env.cache_warm_urls:
+        needed["warmcache"] = "fill the page cache of the new release"
+    if remote.get("running", "0") in ("", "0"):
+        needed["restart"] = "gunicorn is not running"
+    elif set(needed) & set(["upload", "requirements", "templates"]):
+        needed["restart"] = "load the new version"
+    if env.thumbnails and "upload" in needed:
+        needed["thumbnails"] = "templates may use new sizes"
+    return [(stage, needed[stage]) for stage in deploy_stages if stage in needed]
+
+
+def print_plan(stages):
+    """
+    Prints the stages of a deploy plan with their estimated durations.
+    """
+    if not stages:
+        _print(green("Nothing to deploy, the server is up to date.", bold=True))
+        return
+    timings = load_timings()
+    lines = ["%-14s %6s   %s" % (stage, estimate(stage, timings), reason)
+             for stage, reason in stages]
+    names = [stage for stage, reason in stages]
+    finish = {}
+    for name in names:
+        runs = timings.get(name) or [0]
+        if env.deploy_jobs > 1:
+            # Stages running at the same time overlap, only the slowest chain
+            # counts
+            before = [finish[dep] for dep in deploy_dependencies[name]
+                      if dep in finish]
+        else:
+            before = list(finish.values())
+        finish[name] = max(before or [0]) + sum(runs) / len(runs)
+    lines.append("%-14s %6s" % ("total", "~%ss" % int(round(max(finish.values())))))
+    _print(blue("Deploy plan:", bold=True) + "\n" + "\n".join(lines))
+
+
 ##############
 # Deployment #
 ##############
@@ -644,7 +1192,8 @@ def remove():
 @log_call
 def restart():
     """
-    Restart gunicorn worker processes for the project.
+    Restart gunicorn worker processes for the project, and the Twitter
+    poller if it's run by supervisor.
     If the processes are not running, they will be started.
     """
     pid_path = "%s/gunicorn.pid" % env.proj_path
@@ -652,70 +1201,293 @@ def restart():
         run("supervisorctl restart gunicorn_%s" % env.proj_name)
     else:
         run("supervisorctl update")
+    if "twitter" in templates:
+        run("supervisorctl restart twitter_%s" % env.proj_name)
 
 
-@task
-@log_call
-def deploy():
+def deploy_backup():
     """
-    Deploy latest version of the project.
-    Backup current version of the project, push latest version of the project
-    via version control or rsync, install new requirements, sync and migrate
-    the database, collect any new static assets, and restart gunicorn's worker
-    processes for the project.
+    Backs up the database before it's migrated.
     """
-    if not exists(env.proj_path):
-        if confirm("Project does not exist in host server: %s"
-                   "\nWould you like to create it?" % env.proj_name):
-            create()
-        else:
-            abort("Aborted at user request")
+    backup(env.last_db)
 
-    # Backup current version of the project
-    _print(blue("Backing up static files and database...", bold=True))
-    with cd(env.proj_path):
-        backup("last.db")
+
+def deploy_snapshot():
+    """
+    Saves the currently deployed version of the project.
+    """
     if env.deploy_tool in env.vcs_tools:
         with cd(env.repo_path):
             if env.deploy_tool == "git":
                     run("git rev-parse HEAD > %s/last.commit" % env.proj_path)
             elif env.deploy_tool == "hg":
                     run("hg id -i > last.commit")
-        with project():
-            static_dir = static()
-            if exists(static_dir):
-                run("tar -cf static.tar --exclude='*.thumbnails' %s" %
-                    static_dir)
     else:
         with cd(join(env.proj_path, "..")):
             excludes = ["*.pyc", "*.pio", "*.thumbnails"]
             exclude_arg = " ".join("--exclude='%s'" % e for e in excludes)
             run("tar -cf {0}.tar {1} {0}".format(env.proj_name, exclude_arg))
 
-    # Deploy, update requirements, collect static assets, and migrate the DB
-    _print(blue("Deploying the latest version of the project...", bold=True))
-    with update_changed_requirements():
-        if env.deploy_tool in env.vcs_tools:
-            vcs_upload()
-        else:
-            rsync_upload()
-    run("mkdir -p %s" % static())  # Create the STATIC_ROOT
-    remote_path = static() + "/.htaccess"
-    upload_template("deploy/htaccess", remote_path, backup=False)
+
+def deploy_statictar():
+    """
+    Saves the current static files, when deploying with version control.
+    """
+    with cd(env.proj_path):
+        if exists(env.static_root):
+            run("tar -cf static.tar --exclude='*.thumbnails' %s" %
+                env.static_root)
+
+
+def deploy_upload():
+    """
+    Uploads the latest version of the project.
+    """
+    if env.deploy_tool in env.vcs_tools:
+        vcs_upload()
+    else:
+        rsync_upload()
+
+
+def deploy_requirements():
+    """
+    Installs the project requirements.
+    """
+    pip("-r %s/%s" % (env.proj_path, env.reqs_path))
+
+
+def deploy_static():
+    """
+    Collects the static assets into STATIC_ROOT.
+    """
+    static_dir = static()
+    run("mkdir -p %s" % static_dir)  # Create the STATIC_ROOT
+    upload_template("deploy/htaccess", static_dir + "/.htaccess", backup=False)
     manage("collectstatic -v 0 --noinput")
+
+
+def deploy_migrate():
+    """
+    Migrates the database.
+    """
     manage("migrate --noinput")
 
-    # Upload templated config files
-    _print(blue("Uploading configuration files...", bold=True))
-    # Get the application port we saved on create() into the context
-    with tempfile.TemporaryFile() as temp:
-        get("%s/app.port" % env.proj_path, temp)
-        temp.seek(0)
-        port = temp.read()
-        env.gunicorn_port = port.strip()
-    for name in get_templates():
+
+def deploy_templates():
+    """
+    Uploads the templated config files that changed.
+    """
+    for name in env.stale_templates:
         upload_template_and_reload(name)
+
+
+def deploy_compile():
+    """
+    Precompiles the project and the virtualenv, so gunicorn workers don't
+    compile everything on their first import after the restart.
+    """
+    # Each top level package is compiled by its own process
+    targets = "find %s %s/lib/python*/site-packages -mindepth 1 -maxdepth 1 " \
+              "-not -name static \\( -type d -o -name '*.py' \\)" % (
+                  env.proj_path, env.venv_path)
+    command = "%s | xargs -P %s -n 1 %s/bin/python -m compileall -q" % (
+        targets, env.compile_jobs, env.venv_path)
+    with fab_settings(warn_only=True):
+        result = run(command)
+    if result.failed:
+        # Some packages ship modules for other Python versions
+        print(yellow("Some files couldn't be compiled, they will be "
+                     "compiled on import if needed.", bold=True))
+
+
+def deploy_warmcache():
+    """
+    Caches the key pages under the new release's key prefix before
+    gunicorn starts serving it. The old release's pages age out.
+    """
+    with fab_settings(warn_only=True):
+        python_script("deploy/warmcache.py", " ".join(quote(arg) for arg in (
+            [env.proj_app, env.live_host] + list(env.cache_warm_urls))))
+
+
+def deploy_restart():
+    """
+    Restarts gunicorn to load the new version.
+    """
     restart()
+
+
+def deploy_thumbnails():
+    """
+    Generates the missing thumbnails.
+    """
+    thumbnails()
+
+
+class StageOutput(object):
+    """
+    A stream prefixing every line written to it with the name of the deploy
+    stage writing it.
+    """
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.prefix = "[%s] " % name
+        self.line = ""
+
+    def write(self, data):
+        # Only whole lines are written, so stages don't mix their output
+        lines = (self.line + data).split("\n")
+        self.line = lines.pop()
+        if lines:
+            self.stream.write("".join("%s%s\n" % (self.prefix, line)
+                                      for line in lines))
+            self.stream.flush()
+
+    def close(self):
+        if self.line:
+            self.write("\n")
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_stage(name):
+    """
+    Runs a deploy stage in a child process, with its own SSH connection and
+    its output prefixed with its name.
+    """
+    # Connections are shared with the parent and can't be used
+    connections.clear()
+    env.linewise = True
+    sys.stdout = StageOutput(sys.stdout, name)
+    sys.stderr = StageOutput(sys.stderr, name)
+    try:
+        globals()["deploy_%s" % name]()
+    finally:
+        sys.stdout.close()
+        sys.stderr.close()
+
+
+def print_stage_failed(name):
+    """
+    Warns about a failed deploy stage the site works without.
+    """
+    _print(yellow("Deploy stage %s failed, the deploy carries on without it."
+                  % name, bold=True))
+
+
+def run_stages(names):
+    """
+    Runs the deploy stages in separate processes, starting each one as soon
+    as the stages it depends on are done, with DEPLOY_JOBS at most at the
+    same time. If a stage fails, the running ones are stopped and the
+    deploy is aborted, unless the site works without it.
+    """
+    # Children collecting their copy of the helper's channel would close it
+    stop_django_helper()
+    pending = list(names)
+    running = {}
+    done = set()
+    while pending or running:
+        for name in list(pending):
+            deps = [dep for dep in deploy_dependencies[name] if dep in names]
+            if len(running) < env.deploy_jobs and done.issuperset(deps):
+                _print(blue("Starting deploy stage: %s" % name, bold=True))
+                pending.remove(name)
+                sys.stdout.flush()
+                process = multiprocessing.Process(target=run_stage, args=(name,))
+                process.start()
+                running[name] = (process, time.time())
+        time.sleep(0.1)
+        for name, (process, start) in list(running.items()):
+            if process.is_alive():
+                continue
+            del running[name]
+            if process.exitcode == 0:
+                save_timing(name, time.time() - start)
+                _print(green("Finished deploy stage: %s" % name, bold=True))
+            elif name in deploy_best_effort:
+                print_stage_failed(name)
+            else:
+                for other, _ in running.values():
+                    other.terminate()
+                    other.join()
+                abort("Deploy stage %s failed, stopped the other stages." % name)
+            done.add(name)
+
+
+@task
+@log_call
+def plan(full=False):
+    """
+    Shows the stages the next deploy would run, without running them.
+    Pass full=True to plan every stage regardless of the server state.
+    """
+    stages = plan_deploy(full=as_bool(full))
+    print_plan(stages)
+    return stages
+
+
+@task
+@log_call
+def deploy(full=False):
+    """
+    Deploy latest version of the project.
+    Compare the server with the local project and run only the stages that
+    are needed: backup the database and current version of the project, push
+    latest version of the project via version control or rsync, install new
+    requirements, collect any new static assets, migrate the database, upload
+    changed config files, and restart gunicorn's worker processes for the
+    project. Stages not depending on each other run at the same time.
+    Pass full=True to run every stage.
+    """
+    if not exists(env.proj_path):
+        if confirm("Project does not exist in host server: %s"
+                   "\nWould you like to create it?" % env.proj_name):
+            create()
+            full = True
+        else:
+            abort("Aborted at user request")
+
+    stages = plan_deploy(full=as_bool(full))
+    print_plan(stages)
+    if not stages:
+        return True
+    names = [stage for stage, reason in stages]
+    # Rollback must not restore what an earlier deploy saved
+    stale = []
+    if "upload" not in names:
+        stale.append(snapshot_path())
+    if "backup" not in names:
+        stale.append(env.last_db)
+    if stale:
+        run("rm -f %s" % " ".join(stale))
+    if "statictar" in names:
+        # Read before the new code is uploaded
+        with project():
+            env.static_root = static()
+    if env.deploy_jobs > 1:
+        run_stages(names)
+    else:
+        for name in names:
+            _print(blue("Running deploy stage: %s" % name, bold=True))
+            start = time.time()
+            try:
+                globals()["deploy_%s" % name]()
+            except (Exception, SystemExit):
+                if name not in deploy_best_effort:
+                    raise
+                print_stage_failed(name)
+                continue
+            save_timing(name, time.time() - start)
+
+    # Record what has been deployed for the next plan
+    lcl = env.local_state
+    recorded = ["%s=%s" % (key, lcl[key])
+                for key in ("code", "static", "migrations")]
+    run("printf '%%s\\n' %s > %s" % (" ".join(recorded), deploy_state_path()),
+        show=False)
     return True
 
 
@@ -727,8 +1499,13 @@ def rollback():
     When a deploy is performed, the current state of the project is
     backed up. This includes the project files, the database, and all static
     files. Calling rollback will revert all of these to their state prior to
-    the last deploy.
+    the last deploy. The database is only restored if the last deploy
+    migrated it, and nothing is if it didn't upload new code.
     """
+    if not exists(snapshot_path()):
+        abort("The last deploy didn't upload a new version of the project, "
+              "there's nothing to roll back to.")
+    stop_django_helper()
     with update_changed_requirements():
         if env.deploy_tool in env.vcs_tools:
             with cd(env.repo_path):
@@ -744,8 +1521,17 @@ def rollback():
             with cd(env.proj_path.rsplit("/", 1)[0]):
                 run("rm -rf %s" % env.proj_name)
                 run("tar -xf %s.tar" % env.proj_name)
-    with cd(env.proj_path):
-        restore("last.db")
+    if env.deploy_tool in env.vcs_tools:
+        # Unlike the rsync snapshot, checkouts don't restore the settings. Stamp
+        # them with the restored release, so it doesn't serve the pages cached
+        # by the one rolled back.
+        with hide("stdout"):
+            env.cache_release = run("cat %s" % snapshot_path(), show=False)[:8]
+        upload_template_and_reload("settings")
+    if exists(env.last_db):
+        restore(env.last_db)
+    # The next deploy can't trust the recorded state anymore
+    run("rm -f %s" % deploy_state_path())
     restart()
 
 
@@ -815,8 +1601,89 @@ def pullmedia():
 def pushmedia():
     """
     Upload the local media files into the remote MEDIA_ROOT.
+    If THUMBNAILS is enabled, generate their thumbnails too.
     """
     cpmedia(upload=True)
+    if env.thumbnails:
+        thumbnails()
+
+
+@task
+@log_call
+def thumbnails(sizes="auto", jobs=None):
+    """
+    Generates the thumbnails of new or changed images in the remote
+    MEDIA_ROOT, for the sizes used by the {% thumbnail %} tags in the
+    templates, or the given ones: sizes="90x90;300x0".
+    """
+    jobs = int(jobs or env.thumbnail_jobs)
+    python_script("deploy/thumbnails.py", "%s %s %s" % (
+        quote(env.proj_app), jobs, quote(sizes.replace(";", ","))))
+
+
+@task
+@log_call
+def importprofile(limit=25):
+    """
+    Profiles the imports done when loading the WSGI application in the
+    server, and reports the slowest modules.
+    """
+    with hide("stdout"):
+        output = python_script("deploy/importprofile.py",
+                               "%s.wsgi %s" % (env.proj_app, int(limit)))
+    lines = output.splitlines()
+    header = "%10s %10s  %s" % ("self (ms)", "cumul (ms)", "module")
+    _print(blue(lines[0], bold=True) + "\n" + header + "\n" +
+           "\n".join(lines[1:]))
+
+
+@task
+@log_call
+def analyze_logs(hours=24, limit=15):
+    """
+    Reports throughput, latency percentiles, status codes and the slowest
+    endpoints from the gunicorn access log over the last hours.
+    """
+    if env.use_access_log == "#":
+        abort("Set ACCESS_LOG to True in the FABRIC dictionary and deploy first.")
+    with hide("stdout"):
+        output = python_script("deploy/analyzelogs.py", "%s %s %s %s" % (
+            quote(env.access_log), quote(env.proj_app), float(hours), int(limit)))
+    _print(output)
+
+
+def dbmaint_cronjob():
+    """
+    Returns the cronjob running the database maintenance script deployed
+    with the project. It only depends on the settings, so remove() deletes
+    the exact line dbmaint:cron=True registered.
+    """
+    return "%s cd %s && %s/bin/python deploy/dbmaint.py %s 10 yes " \
+           ">> /home/%s/logs/user/%s_dbmaint.log 2>&1" % (
+               env.dbmaint_schedule, env.proj_path, env.venv_path,
+               env.proj_app, env.user, env.proj_name)
+
+
+@task
+@log_call
+def dbmaint(vacuum=True, limit=10, cron=False):
+    """
+    Reports table sizes, estimated bloat, dead rows, scan ratios and missing
+    indexes in the remote database, and runs VACUUM ANALYZE on the tables
+    that need it most. Pass cron=True to schedule it as a cronjob instead,
+    which always shows 10 tables per section.
+    """
+    if as_bool(cron):
+        if not env.dbmaint_schedule:
+            abort("DBMAINT_SCHEDULE not set in deployment settings.")
+        srv, ssn, acn = get_webf_session()
+        srv.create_cronjob(ssn, dbmaint_cronjob())
+        print("New cronjob. The database will be maintained at '%s', logging "
+              "to ~/logs/user/%s_dbmaint.log." % (
+                  env.dbmaint_schedule, env.proj_name))
+        return
+    python_script("deploy/dbmaint.py", "%s %s %s" % (
+        env.proj_app, int(limit), "yes" if as_bool(vacuum) else "no"))
 
 
 @task
@@ -838,9 +1705,15 @@ def setup_email():
 @log_call
 def setup_twitter():
     """
-    Setup a cron job to poll Twitter periodically.
+    Setup a cron job to poll Twitter periodically, or a resident poller run
+    by supervisor if TWITTER_MODE is "supervisor".
     """
-    if isinstance(env.twitter_period, int):
+    if "twitter" in templates:
+        upload_template_and_reload("twitter")
+        print("New supervisor program. Twitter will be polled every %s minutes. "
+              "Please make sure you have configured your Twitter credentials "
+              "in your site settings." % env.twitter_period)
+    elif isinstance(env.twitter_period, int):
         srv, ssn, acn = get_webf_session()
         srv.create_cronjob(ssn, "*/%s * * * * %s poll_twitter" % (
             env.twitter_period, env.manage))
@@ -19,9 +19,18 @@ FABRIC = {
     "REQUIREMENTS_PATH": "requirements.txt",  # Project's pip requirements
     "LOCALE": "en_US.UTF-8",  # Should end with ".UTF-8"
     "NUM_WORKERS": 2,  # Limit the amount of workers for gunicorn
+    # "COMPILE_JOBS": 4,  # Parallel processes used to precompile bytecode
+    # "DEPLOY_JOBS": 4,  # Deploy stages run at the same time, 1 to run in order
+    # "ACCESS_LOG": False,  # Log requests and their duration for analyze_logs
+    # "DJANGO_HELPER": False,  # Keep one Django process per session for commands
+    # "THUMBNAILS": False,  # Generate thumbnails after pushmedia and deploy
+    # "THUMBNAIL_JOBS": 2,  # Parallel processes used to generate thumbnails
+    # "CACHE_WARM_URLS": ["/"],  # Pages cached for each release before restarting
     # "DB_PASS": "",  # Live database password
     # "ADMIN_PASS": "",  # Live admin user password
     # "TWITTER_PERIOD": None,  # Minutes
+    # "TWITTER_MODE": "cron",  # Poll Twitter with a "cron" job or "supervisor"
+    # "DBMAINT_SCHEDULE": "30 4 * * *",  # Cron schedule for database maintenance
     "SECRET_KEY": SECRET_KEY,
     "NEVERCACHE_KEY": NEVERCACHE_KEY,
 